@@ -4,10 +4,13 @@
 # this implementation only supports Unsup-SimCSE.
 # if you want to run the training of Sup-SimCSE, please modify this code yourself.
 
+import inspect
 import json
 import os
 import random
+import tempfile
 from dataclasses import dataclass
+from functools import partial
 from pathlib import Path
 from typing import Dict, List, Union
 
@@ -29,6 +32,14 @@ from transformers.tokenization_utils import BatchEncoding, PreTrainedTokenizer
 
 from sts import STSEvaluation
 
+try:
+    from transformers.utils import is_torch_sdpa_available
+except ImportError:
+    # transformers < 4.36 does not support `attn_implementation`
+    def is_torch_sdpa_available() -> bool:
+        return False
+
+
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 
@@ -56,6 +67,9 @@ class Args:
 
     # see Table D.1 of the paper
     temperature: float = 0.05
+    # use the symmetric InfoNCE loss (emb1 -> emb2 and emb2 -> emb1) as in CLIP.
+    # this gives more training signal per step, but it is not used in the paper, so it is disabled by default.
+    symmetric_loss: bool = False
 
     # FYI: max_seq_len of reference implementation is 32
     # it seems short, but it is enough for the STS task
@@ -70,8 +84,18 @@ class Args:
     # see: https://github.com/princeton-nlp/SimCSE/blob/511c99d4679439c582beb86a0372c04865610b6b/run_unsup_example.sh
     eval_logging_interval: int = 250
 
+    # mixed precision training with `torch.autocast`: one of "bf16", "fp16", or "fp32" (i.e. disabled)
+    # it is disabled by default because the results in `results/` are obtained with fp32 training.
+    # bf16 has the same exponent range as fp32, so it does not need loss scaling (requires Ampere or newer GPUs).
     # if you want to use `fp16`, you may encounter some issues.
     # see: https://github.com/princeton-nlp/SimCSE/issues/38#issuecomment-855457923
+    amp_dtype: str = "fp32"
+    # allow TF32 for fp32 matmuls on Ampere or newer GPUs and let cuDNN benchmark its algorithms.
+    # TF32 is much faster, but it changes fp32 numerics, so it is disabled by default as well as `amp_dtype`.
+    allow_tf32: bool = False
+    # compile the model with `torch.compile` (PyTorch >= 2.0, requires Triton) to reduce the per-operation overhead.
+    # compilation takes a while at the beginning of training, so it is disabled by default.
+    compile: bool = False
     device: str = "cuda:0"
 
     # due to various influences such as implementation and hardware, the same random seed does not always produce the same results.
@@ -82,36 +106,111 @@ class Args:
     seed: int = 42
 
 
-# Reading text line by line is a very simple processing, so we don't need to use a Dataset class actually.
-# However we define a dedicated class for future extensibility.
+# Dataset of line-by-line text, tokenized in advance and cached on disk.
+# the cache is created on the first run and reused as long as the dataset file and tokenizer settings are unchanged.
 @dataclass
 class SimCSEDataset(Dataset):
     path: Path
-    data: List[str] = None
-
-    # For simplicity, this dataset class is designed to tokenize text for each loop,
-    # but if performance is more important, you should tokenize all text in advance.
+    tokenizer: PreTrainedTokenizer
+    max_seq_len: int
+    # tokenized inputs, e.g. {"input_ids": (num_samples, max_seq_len), "attention_mask": (num_samples, max_seq_len)}
+    arrays: Dict[str, np.ndarray] = None
+
+    # all text is tokenized and padded in advance, and saved as `.npy` files next to the dataset.
+    # the files are memory-mapped, so DataLoader workers share them through the OS page cache
+    # and samples are read without any Python-level processing.
+    # tokenizing each batch in the training loop is simpler, but it can be a bottleneck of training.
     def __post_init__(self):
-        self.data = []
-        with self.path.open() as f:
-            # to prevent whole text into memory at once
-            for line in f:
-                line = line.strip()
-                if line:
-                    self.data.append(line)
+        # RoBERTa variants don't use token_type_ids, so we don't store (and transfer) them
+        input_names = [
+            name
+            for name in ["input_ids", "attention_mask", "token_type_ids"]
+            if name in self.tokenizer.model_input_names
+        ]
+        tokenizer_name = self.tokenizer.name_or_path.replace("/", "__")
+        # the size and modification time of the dataset are included in the file names,
+        # so cached arrays are not reused when the dataset file is replaced or edited
+        stat = self.path.stat()
+        cache_prefix = f"{self.path.stem}.{stat.st_size}-{stat.st_mtime_ns}.{tokenizer_name}.{self.max_seq_len}"
+        cache_paths = {
+            name: self.path.parent / f"{cache_prefix}.{name}.npy"
+            for name in input_names
+        }
+
+        if not all(path.exists() for path in cache_paths.values()):
+            data = []
+            with self.path.open() as f:
+                # to prevent whole text into memory at once
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        data.append(line)
+
+            arrays = {
+                name: np.empty((len(data), self.max_seq_len), dtype=np.int32)
+                for name in input_names
+            }
+            # tokenizing the whole dataset at once takes a lot of memory, so we tokenize it chunk by chunk
+            chunk_size = 10000
+            for start in range(0, len(data), chunk_size):
+                texts = data[start : start + chunk_size]
+                # pad all samples to the same length to avoid recompilations of `torch.compile`
+                encodings = self.tokenizer(
+                    texts,
+                    padding="max_length",
+                    truncation=True,
+                    max_length=self.max_seq_len,
+                    return_token_type_ids="token_type_ids" in input_names,
+                    return_tensors="np",
+                )
+                for name in input_names:
+                    arrays[name][start : start + len(texts)] = encodings[name]
+
+            for name, path in cache_paths.items():
+                # write to a unique temporary file first and rename it,
+                # so that an interrupted run does not leave a truncated cache file
+                # and runs in parallel (e.g. with different seeds) don't overwrite each other's files
+                with tempfile.NamedTemporaryFile(
+                    dir=path.parent, suffix=".tmp", delete=False
+                ) as f:
+                    np.save(f, arrays[name])
+                os.replace(f.name, path)
+
+                # remove caches of older versions of the dataset, which are never used again
+                pattern = f"{self.path.stem}.*.{tokenizer_name}.{self.max_seq_len}.{name}.npy"
+                for old_path in self.path.parent.glob(pattern):
+                    if old_path != path:
+                        old_path.unlink(missing_ok=True)
+
+        self.arrays = {
+            name: np.load(path, mmap_mode="r") for name, path in cache_paths.items()
+        }
 
-    def __getitem__(self, index: int) -> Tensor:
-        return self.data[index]
+    def __getitem__(self, index: int) -> Dict[str, np.ndarray]:
+        return {name: array[index] for name, array in self.arrays.items()}
 
     def __len__(self) -> int:
-        return len(self.data)
+        return len(self.arrays["input_ids"])
 
 
 class SimCSEModel(nn.Module):
     def __init__(self, model_name: str):
         super().__init__()
         # you can use any models
-        self.backbone: PreTrainedModel = AutoModel.from_pretrained(model_name)
+        # if available, we use the fused scaled-dot-product attention (FlashAttention / memory-efficient attention)
+        # instead of the naive implementation, which materializes attention probabilities explicitly.
+        # see: https://pytorch.org/docs/stable/generated/torch.nn.functional.scaled_dot_product_attention.html
+        # some architectures don't support SDPA, so we fall back to the default implementation for them.
+        self.backbone: PreTrainedModel = None
+        if is_torch_sdpa_available():
+            try:
+                self.backbone = AutoModel.from_pretrained(
+                    model_name, attn_implementation="sdpa"
+                )
+            except ValueError:
+                pass
+        if self.backbone is None:
+            self.backbone = AutoModel.from_pretrained(model_name)
 
         # define additional MLP layer
         # see Section 6.3 of the paper for more details
@@ -158,26 +257,111 @@ def set_seed(seed):
     torch.cuda.manual_seed_all(seed)
 
 
+# each DataLoader worker has its own torch seed (derived from the DataLoader's generator),
+# but numpy and random are not seeded per worker, so we seed them here.
+# see: https://pytorch.org/docs/stable/notes/randomness.html#dataloader
+def seed_worker(worker_id: int):
+    worker_seed = torch.initial_seed() % 2**32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+
+# SimCSE training objective:
+#    maximize the similarity between the same sentence
+# => make diagonal elements most similar
+def simcse_loss(
+    emb1: Tensor,
+    emb2: Tensor,
+    labels: Tensor,
+    temperature: float,
+    symmetric: bool = False,
+) -> Tensor:
+    # the loss is computed in fp32 even under autocast,
+    # because half precision errors of logits are amplified by the temperature (e.g. 1 / 0.05 = 20).
+    # (`F.cosine_similarity` is computed in fp32 by autocast, but matmuls are not)
+    with torch.autocast(device_type=emb1.device.type, enabled=False):
+        # shape of sim_matrix: (batch_size, batch_size)
+        # calculate cosine similarity between all pair of embeddings (n x n)
+        # cosine similarity is the dot product of L2-normalized vectors,
+        # so a single matrix multiplication computes all pairs without a (n x n x hidden_size) intermediate tensor.
+        # this is equivalent to `F.cosine_similarity(emb1.unsqueeze(1), emb2.unsqueeze(0), dim=-1)`
+        emb1, emb2 = emb1.float(), emb2.float()
+        sim_matrix = F.normalize(emb1, dim=-1) @ F.normalize(emb2, dim=-1).T
+        # FYI: SimCSE is sensitive for the temperature parameter.
+        # see Table D.1 of the paper
+        sim_matrix = sim_matrix / temperature
+
+        # it may seem strange to use Cross-Entropy Loss here.
+        # this is a shorthund of doing SoftMax and maximizing the similarity of diagonal elements
+        loss = F.cross_entropy(sim_matrix, labels)
+        if symmetric:
+            # the transposed matrix treats emb2 as queries and emb1 as keys
+            loss = (loss + F.cross_entropy(sim_matrix.T, labels)) / 2
+        return loss
+
+
+AMP_DTYPES = {
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+    "fp32": torch.float32,
+}
+
+
 def main(args: Args):
+    # validate arguments before loading the model and the dataset, which takes a while
+    if args.amp_dtype not in AMP_DTYPES:
+        raise ValueError(
+            f"amp_dtype must be one of {list(AMP_DTYPES)}, but got {args.amp_dtype!r}"
+        )
+    amp_dtype = AMP_DTYPES[args.amp_dtype]
+
     logging.set_verbosity_error()
     set_seed(args.seed)
     args.output_dir.mkdir(parents=True, exist_ok=True)
 
-    tokenizer: PreTrainedTokenizer = AutoTokenizer.from_pretrained(args.model_name)
+    # TF32 speeds up fp32 matmuls on Ampere or newer GPUs at the cost of a shorter mantissa (10 bits)
+    # and cuDNN benchmark mode picks the fastest algorithms for each input shape
+    # see: https://pytorch.org/docs/stable/notes/cuda.html#tensorfloat-32-tf32-on-ampere-devices
+    if args.allow_tf32:
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.backends.cudnn.benchmark = True
+        torch.set_float32_matmul_precision("high")
+
+    # fast (Rust-based) tokenizers are much faster than Python-based ones for batch tokenization
+    tokenizer: PreTrainedTokenizer = AutoTokenizer.from_pretrained(
+        args.model_name, use_fast=True
+    )
     model: SimCSEModel = SimCSEModel(args.model_name).to(args.device)
 
-    train_dataset = SimCSEDataset(args.dataset_dir / "train.txt")
+    # `torch.compile` fuses operations of the model and captures CUDA graphs,
+    # which removes most of the per-operation overhead of small-batch training.
+    # the compiled model shares parameters with `model`, so `model` is used for evaluation and saving as is.
+    # evaluation batches have various shapes, so compiling it for evaluation would cause many recompilations.
+    # the loss is a chain of small operations (normalize -> matmul -> divide -> cross entropy),
+    # so `torch.compile` fuses them into a few kernels.
+    train_model, loss_fn = model, simcse_loss
+    if args.compile and hasattr(torch, "compile"):
+        train_model = torch.compile(model, mode="reduce-overhead", fullgraph=False)
+        loss_fn = torch.compile(simcse_loss)
+
+    train_dataset = SimCSEDataset(
+        args.dataset_dir / "train.txt",
+        tokenizer=tokenizer,
+        max_seq_len=args.max_seq_len,
+    )
 
     # `collate_fn` is for processing the list of samples to form a batch
     # see: https://discuss.pytorch.org/t/how-to-use-collate-fn/27181
-    def collate_fn(batch: List[str]) -> BatchEncoding:
-        return tokenizer(
-            batch,
-            padding=True,
-            truncation=True,
-            return_tensors="pt",
-            max_length=args.max_seq_len,
-        )
+    # samples are already tokenized and padded by `SimCSEDataset`, so we only have to stack them here
+    def collate_fn(batch: List[Dict[str, np.ndarray]]) -> Dict[str, Tensor]:
+        return {
+            name: torch.from_numpy(np.stack([sample[name] for sample in batch])).long()
+            for name in batch[0]
+        }
+
+    generator = torch.Generator()
+    generator.manual_seed(args.seed)
 
     # see: https://pytorch.org/docs/stable/data.html
     #      https://pytorch.org/tutorials/beginner/basics/data_tutorial.html
@@ -187,18 +371,44 @@ def main(args: Args):
         batch_size=args.batch_size,
         shuffle=True,
         # num_workers and pin_memory are for speeding up training
-        num_workers=4,
+        # `os.cpu_count()` may return None, and we keep at least 4 workers as before
+        num_workers=max(4, min(8, (os.cpu_count() or 2) // 2)),
         pin_memory=True,
+        # keep workers alive across epochs and prepare more batches in advance so that the GPU does not wait for data
+        persistent_workers=True,
+        prefetch_factor=4,
         # batch_size varies in the last batch because
         # the last batch size will be the number of remaining samples (i.e. len(train_dataloader) % batch_size)
         # to avoid unstablity of contrastive learning, we drop the last batch
         drop_last=True,
+        # a dedicated generator makes shuffling reproducible independently of the global random state
+        generator=generator,
+        worker_init_fn=seed_worker,
     )
 
     # FYI: huggingface/transformers' AdamW implementation is deprecated and you should use PyTorch's AdamW instead.
     # see: https://github.com/huggingface/transformers/issues/3407
     #      https://github.com/huggingface/transformers/issues/18757
-    optimizer = torch.optim.AdamW(params=model.parameters(), lr=args.lr)
+    # `fused=True` runs the whole parameter update as a single CUDA kernel (available for AdamW since PyTorch 2.0).
+    # if you observe a different loss curve, fall back to the default implementation by removing `**optimizer_kwargs`.
+    optimizer_kwargs = {}
+    if "fused" in inspect.signature(torch.optim.AdamW).parameters:
+        optimizer_kwargs["fused"] = torch.device(args.device).type == "cuda"
+    optimizer = torch.optim.AdamW(
+        params=model.parameters(), lr=args.lr, **optimizer_kwargs
+    )
+
+    # mixed precision: forward passes and loss computation run under `torch.autocast`,
+    # so matmuls in BERT are executed in half precision (using Tensor Cores on recent GPUs).
+    # fp16 has a narrow dynamic range, so gradients are scaled by `GradScaler` to prevent underflow.
+    # see: https://pytorch.org/docs/stable/notes/amp_examples.html
+    autocast = partial(
+        torch.autocast,
+        device_type=torch.device(args.device).type,
+        dtype=amp_dtype,
+        enabled=amp_dtype != torch.float32,
+    )
+    scaler = torch.cuda.amp.GradScaler(enabled=amp_dtype == torch.float16)
 
     # reference implementation uses a linear scheduler with warmup, which is a default scheduler of transformers' Trainer
     # with num_training_steps = 0 (i.e. no warmup)
@@ -221,7 +431,8 @@ def main(args: Args):
     def encode(texts: List[str]) -> torch.Tensor:
         embs = []
         model.eval()
-        for text in chunked(texts, args.batch_size * 8):
+        # no gradients are stored during evaluation, so we can use much larger batches than in training
+        for text in chunked(texts, args.batch_size * 16):
             batch: BatchEncoding = tokenizer(
                 text,
                 padding=True,
@@ -230,15 +441,21 @@ def main(args: Args):
             )
             # SimCSE uses MLP layer only during training
             # in this implementation, we use `model.training` to switch between training and evaluation
-            emb = model(**batch.to(args.device))
-            embs.append(emb.cpu())
+            # evaluation also runs under autocast with the same `amp_dtype` as training
+            with autocast():
+                emb = model(**batch.to(args.device))
+            # keep embeddings on the device to avoid synchronization for each batch
+            embs.append(emb)
+        # transfer all embeddings to CPU at once
+        # cast back to fp32 because numpy (used in evaluation) does not support bf16
         # shape of output: (len(texts), hidden_size)
-        return torch.cat(embs, dim=0)
+        return torch.cat(embs, dim=0).float().cpu()
 
     # evaluation before training
     model.eval()
     best_stsb = sts.dev(encode=encode)
     best_step = 0
+    best_state_dict: Dict[str, Tensor] = None
 
     # evaluate the model and store metrics before training
     # this is important to check the appropriateness of training procedure
@@ -252,6 +469,11 @@ def main(args: Args):
         }
     ]
 
+    # labels := [0, 1, 2, ..., batch_size - 1]
+    # labels indicate the index of the diagonal element (i.e. positive examples)
+    # batch size is constant thanks to `drop_last=True`, so labels are created only once
+    labels = torch.arange(args.batch_size, dtype=torch.long, device=args.device)
+
     # finally, start training!
     for epoch in range(args.epochs):
         model.train()
@@ -263,42 +485,42 @@ def main(args: Args):
             dynamic_ncols=True,
         ):
             # transfer batch to the device
-            batch: BatchEncoding = batch.to(args.device)
+            # batches are in pinned memory (`pin_memory=True`), so the copy can run asynchronously with `non_blocking=True`
+            # `BatchEncoding.to` does not accept `non_blocking` in older transformers, so we move each tensor manually
+            batch: Dict[str, Tensor] = {
+                k: v.to(args.device, non_blocking=True) for k, v in batch.items()
+            }
             # if you want to see the actual data, please uncomment the following line.
             # print(batch)
             # and also, if you want to see the actual input strings, please uncomment the following line.
-            # print(tokenizer.batch_decode(batch.input_ids, skip_special_tokens=True))
-
-            # simply forward inputs twice!
-            # different dropout masks are adapt automatically
-            emb1 = model.forward(**batch)
-            emb2 = model.forward(**batch)
-
-            # SimCSE training objective:
-            #    maximize the similarity between the same sentence
-            # => make diagonal elements most similar
-
-            # shape of sim_matrix: (batch_size, batch_size)
-            # calculate cosine similarity between all pair of embeddings (n x n)
-            sim_matrix = F.cosine_similarity(
-                emb1.unsqueeze(1), emb2.unsqueeze(0), dim=-1
-            )
-            # FYI: SimCSE is sensitive for the temperature parameter.
-            # see Table D.1 of the paper
-            sim_matrix = sim_matrix / args.temperature
-
-            # labels := [0, 1, 2, ..., batch_size - 1]
-            # labels indicate the index of the diagonal element (i.e. positive examples)
-            labels = torch.arange(args.batch_size).long().to(args.device)
-            # it may seem strange to use Cross-Entropy Loss here.
-            # this is a shorthund of doing SoftMax and maximizing the similarity of diagonal elements
-            loss = F.cross_entropy(sim_matrix, labels)
+            # print(tokenizer.batch_decode(batch["input_ids"], skip_special_tokens=True))
+
+            with autocast():
+                # each input is encoded twice with different dropout masks!
+                # instead of calling `model.forward` twice, we duplicate the batch and forward it at once,
+                # which launches half as many kernels and feeds larger matrices to the GPU.
+                # dropout masks are sampled per element, so the two copies still get different masks.
+                # shape of doubled inputs: (batch_size * 2, seq_len)
+                doubled = {k: torch.cat([v, v], dim=0) for k, v in batch.items()}
+                emb1, emb2 = train_model(**doubled).chunk(2, dim=0)
+
+                loss = loss_fn(
+                    emb1,
+                    emb2,
+                    labels=labels,
+                    temperature=args.temperature,
+                    symmetric=args.symmetric_loss,
+                )
 
-            optimizer.zero_grad()
-            loss.backward()
+            # `scaler` is a no-op unless `amp_dtype` is fp16
+            scaler.scale(loss).backward()
 
-            optimizer.step()
+            scaler.step(optimizer)
+            scaler.update()
             lr_scheduler.step()
+            # gradients are reset right after the update.
+            # `set_to_none=True` releases gradients instead of filling them with zeros, which saves a memory write.
+            optimizer.zero_grad(set_to_none=True)
 
             # for every `args.eval_logging_interval` steps, perform evaluation on STS task and print logs
             if (step + 1) % args.eval_logging_interval == 0 or (step + 1) == len(
@@ -313,25 +535,33 @@ def main(args: Args):
                 if best_stsb < stsb_score:
                     best_stsb = stsb_score
                     best_step = step + 1
-                    # only save the best performing model
-                    torch.save(model.state_dict(), args.output_dir / "model.pt")
+                    # only keep the best performing model
+                    # writing the model to disk takes a while, so we keep a copy of its parameters in CPU memory
+                    # and save it only once after training
+                    best_state_dict = {
+                        k: v.detach().to("cpu", copy=True)
+                        for k, v in model.state_dict().items()
+                    }
 
+                # `loss.item()` waits for the GPU to finish all queued kernels,
+                # so it is called only here (once per evaluation) and not in every step
+                loss_value = loss.item()
                 # use `tqdm.write` instead of `print` to prevent terminal display corruption
                 tqdm.write(
-                    f"epoch: {epoch:>3} |\tstep: {step+1:>6} |\tloss: {loss.item():.10f} |\tSTSB: {stsb_score:.4f}"
+                    f"epoch: {epoch:>3} |\tstep: {step+1:>6} |\tloss: {loss_value:.10f} |\tSTSB: {stsb_score:.4f}"
                 )
                 logs.append(
                     {
                         "epoch": epoch,
                         "step": step + 1,
-                        "loss": loss.item(),
+                        "loss": loss_value,
                         "stsb": stsb_score,
                     }
                 )
                 pd.DataFrame(logs).to_csv(args.output_dir / "logs.csv", index=False)
 
                 # if you want to see the changes of similarity matrix, uncomment the following line
-                # tqdm.write(str(sim_matrix))
+                # tqdm.write(str(F.normalize(emb1, dim=-1) @ F.normalize(emb2, dim=-1).T))
                 model.train()
 
     # save epochs, steps, losses, and STSB dev scores
@@ -342,9 +572,10 @@ def main(args: Args):
         }
         json.dump(data, f, indent=2, ensure_ascii=False)
 
-    # load the best model for final evaluation
-    if (args.output_dir / "model.pt").exists():
-        model.load_state_dict(torch.load(args.output_dir / "model.pt"))
+    # save and load the best model for final evaluation
+    if best_state_dict is not None:
+        torch.save(best_state_dict, args.output_dir / "model.pt")
+        model.load_state_dict(best_state_dict)
     model.eval().to(args.device)
 
     sts_metrics = sts(encode=encode)